@@ -1,21 +1,31 @@
-import os, sys, subprocess, tkinter as tk
+import os, io, importlib.util, threading, contextlib, traceback, tkinter as tk
+from datetime import datetime
 from tkinter import filedialog, messagebox
 
 # CONFIG: percorso di default dove si trova main.py
 DEFAULT_BOOKGEN_DIR = os.path.expanduser("~/Desktop/bookgen")
 
+# main.py caricati per percorso: cartelle bookgen diverse = moduli diversi
+_bookgen_modules = {}
+
+def load_bookgen_main(main_path):
+    mod = _bookgen_modules.get(main_path)
+    if mod is None:
+        spec = importlib.util.spec_from_file_location(
+            f"bookgen_main_{len(_bookgen_modules)}", main_path
+        )
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        _bookgen_modules[main_path] = mod
+    return mod
+
 def pick_book_yaml():
-    path = filedialog.askopenfilename(
-        title="Select book.yaml",
-        filetypes=[("YAML files","*.yaml"), ("All files","*.*")]
-    )
+    path = yaml_dialog.show()
     if path:
         yaml_var.set(path)
 
 def pick_bookgen_dir():
-    path = filedialog.askdirectory(
-        title="Select folder that contains main.py (bookgen)"
-    )
+    path = dir_dialog.show()
     if path:
         bookgen_dir_var.set(path)
 
@@ -27,7 +37,7 @@ def run_bookgen():
     if not os.path.isfile(yaml_path):
         messagebox.showerror("Error", "Select a valid book.yaml.")
         return
-    main_path = os.path.join(bookgen_dir, "main.py")
+    main_path = os.path.abspath(os.path.join(bookgen_dir, "main.py"))
     if not os.path.isfile(main_path):
         messagebox.showerror("Error", f"main.py not found in:\n{bookgen_dir}\n\nPick the correct folder.")
         return
@@ -38,33 +48,65 @@ def run_bookgen():
         messagebox.showerror("Error", "Set your OPENAI_API_KEY (field below) or as environment variable.")
         return
 
-    # Env e cwd corretti:
-    env = os.environ.copy()
-    env["OPENAI_API_KEY"] = api_key
-    # facoltativo: passiamo il percorso YAML allo script (se supportato) oppure
-    # eseguiamo con cwd nella cartella del YAML così che 'book.yaml' venga trovato.
-    yaml_dir = os.path.dirname(yaml_path)
-
-    try:
-        run = subprocess.run(
-            [sys.executable, main_path],  # esegui il file, NON come modulo
-            cwd=yaml_dir,                 # così main.py troverà "book.yaml" nella cwd
-            env=env,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        messagebox.showinfo("Success", f"Book generated!\n\nSTDOUT:\n{run.stdout[-1000:]}")
-    except subprocess.CalledProcessError as e:
-        messagebox.showerror(
-            "Error",
-            f"Book generation failed.\n\nSTDOUT:\n{e.stdout[-1000:]}\n\nSTDERR:\n{e.stderr[-1000:]}"
-        )
+    # Eseguiamo main.py in-process (niente nuovo interprete, niente chdir):
+    # YAML e cartella output passati esplicitamente, output/ accanto al YAML.
+    yaml_dir = os.path.dirname(os.path.abspath(yaml_path))
+
+    run_btn.config(state="disabled")
+    result = {}
+
+    def worker():
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                bookgen_main = load_bookgen_main(main_path)
+                # chiave e RUN_ID passati per chiamata (il modulo resta in cache)
+                bookgen_main.main({
+                    "openai_api_key": api_key,
+                    "run_id": datetime.now().strftime("%Y%m%d-%H%M%S"),
+                    "yaml_path": os.path.abspath(yaml_path),
+                    "output_dir": os.path.join(yaml_dir, "output"),
+                })
+            result["ok"] = True
+        except BaseException:  # main() usa sys.exit() sugli errori
+            traceback.print_exc(file=err)
+            result["ok"] = False
+        result["stdout"], result["stderr"] = out.getvalue(), err.getvalue()
+
+    def poll():
+        if thread.is_alive():
+            root.after(200, poll)
+            return
+        run_btn.config(state="normal")
+        if result.get("ok"):
+            messagebox.showinfo("Success", f"Book generated!\n\nSTDOUT:\n{result['stdout'][-1000:]}")
+        else:
+            messagebox.showerror(
+                "Error",
+                f"Book generation failed.\n\nSTDOUT:\n{result['stdout'][-1000:]}\n\nSTDERR:\n{result['stderr'][-1000:]}"
+            )
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    root.after(200, poll)
 
 # --- GUI ---
 root = tk.Tk()
 root.title("Book Generator")
 
+# Dialog creati una sola volta con parent=root e title esplicito;
+# a GUI ferma pre-carichiamo le proc Tk dei dialog (il primo click non attende).
+yaml_dialog = filedialog.Open(
+    master=root,
+    title="Select book.yaml",
+    filetypes=[("YAML files","*.yaml"), ("All files","*.*")]
+)
+dir_dialog = filedialog.Directory(
+    master=root,
+    title="Select folder that contains main.py (bookgen)"
+)
+root.after_idle(lambda: root.tk.eval("catch {auto_load tk_getOpenFile}; catch {auto_load tk_chooseDirectory}"))
+
 # Vars
 yaml_var = tk.StringVar()
 bookgen_dir_var = tk.StringVar(value=DEFAULT_BOOKGEN_DIR)
@@ -88,6 +130,7 @@ tk.Entry(root, textvariable=api_key_var, width=60, show="•").grid(row=3, colum
 tk.Label(root, text="(used only if env var not set)").grid(row=3, column=2, sticky="w", padx=6, pady=4)
 
 # Run button
-tk.Button(root, text="Run generator", width=20, height=2, command=run_bookgen).grid(row=4, column=0, columnspan=3, pady=12)
+run_btn = tk.Button(root, text="Run generator", width=20, height=2, command=run_bookgen)
+run_btn.grid(row=4, column=0, columnspan=3, pady=12)
 
 root.mainloop()
\ No newline at end of file
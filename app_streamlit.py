@@ -1,123 +1,89 @@
 # app_streamlit.py
 import os
-import re
 import time
-import json
-import sys
-import importlib
-import pathlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import streamlit as st
 
+from bookgen_ui_helpers import (
+    parse_toc_lines,
+    write_book_yaml_locally,
+    find_output_doc,
+    generation_key,
+    cached_output,
+    store_cached_output,
+    get_setting,
+    docx_payload,
+    import_bookgen_main,
+)
+
 APP_TITLE = "Book Generator (Streamlit)"
-ROOT = pathlib.Path(__file__).parent
+APP_CAPTION = "Paste Title, Buyer persona / Voice & Style, and Table of Contents. Click Generate to download the .docx."
+
+_MIME_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+_TITLE_PLACEHOLDER = "e.g., Super Easy Options Trading for Absolute Beginners"
+_PERSONA_PLACEHOLDER = (
+    "Paste the persona (target, tone, must/avoid...).\n\n"
+    "Incolla qui la persona (target, tono, must/avoid,...)."
+)
+_TOC_PLACEHOLDER = (
+    "Example / Esempio:\n"
+    "INTRODUCTION\n"
+    "How to Use This Book for Real Impact\n"
+    "A Note on Ethics and Client Safety\n\n"
+    "PART I – FOUNDATIONS\n"
+    "Chapter 1: Understanding the Basics\n"
+    "How X hides in plain sight\n"
+    "The biology of Y\n"
+)
 
 # ---------- Page ----------
 st.set_page_config(page_title=APP_TITLE, page_icon="📘", layout="centered")
 st.title(APP_TITLE)
-st.caption("Paste Title, Buyer persona / Voice & Style, and Table of Contents. Click Generate to download the .docx.")
+st.caption(APP_CAPTION)
 
 # ---------- Session guard ----------
 if "running" not in st.session_state:
     st.session_state.running = False
 
-# ---------- Helpers ----------
-def safe_title_for_filename(s: str) -> str:
-    return re.sub(r'[\\/:*?"<>|]+', '-', s).strip()
-
-def parse_toc_lines(toc_text: str):
-    """
-    Convert simple pasted TOC to a chapters list usable by book.yaml.
-    - ALL CAPS or 'Chapter/Day N' -> new chapter
-    - following lines -> subsections
-    """
-    lines = [ln.strip(" \t-•").rstrip() for ln in toc_text.splitlines()]
-    lines = [ln for ln in lines if ln]
-
-    chapters = []
-    cur = None
-
-    def is_chapter(ln: str) -> bool:
-        if re.match(r"^(chapter|day)\s+\d+[:\- ]", ln, flags=re.I):
-            return True
-        letters = re.sub(r"[^A-Za-z]+", "", ln)
-        if letters and ln == ln.upper() and len(ln) >= 4:
-            return True
-        if ln.upper().startswith("PART "):
-            return True
-        return False
-
-    for ln in lines:
-        if is_chapter(ln):
-            if cur:
-                chapters.append(cur)
-            cur = {"title": ln, "subs": []}
-        else:
-            if not cur:
-                cur = {"title": "Introduction", "subs": []}
-            cur["subs"].append(ln)
-
-    if cur:
-        chapters.append(cur)
-    return chapters
-
-def write_book_yaml_locally(title: str, persona: str, chapters_list: list) -> Path:
-    """
-    Write a minimal book.yaml expected by bookgen/main.py.
-    (JSON syntax that yaml.safe_load can read.)
-    """
-    data = {
-        "title": title,
-        "persona": persona,
-        "toc": [{c["title"]: c["subs"]} if c["subs"] else c["title"] for c in chapters_list],
-    }
-    p = Path("book.yaml")
-    p.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    return p
-
-def find_output_doc(title: str, run_id: str) -> Path | None:
-    safe = safe_title_for_filename(title)
-    p = Path("output") / f"BOOK - {safe} - {run_id}.docx"
-    return p if p.exists() else None
-
-def import_bookgen_main():
-    """Import bookgen.main after env + book.yaml are ready."""
-    if str(ROOT) not in sys.path:
-        sys.path.insert(0, str(ROOT))
-    return importlib.import_module("bookgen.main")
-
 # ---------- UI (FORM) ----------
 with st.form("book_form", clear_on_submit=False):
     title = st.text_input(
         "Title / Titolo",
-        placeholder="e.g., Super Easy Options Trading for Absolute Beginners",
+        placeholder=_TITLE_PLACEHOLDER,
     )
     persona = st.text_area(
         "Buyer persona / Voice & Style",
         height=220,
-        placeholder=(
-            "Paste the persona (target, tone, must/avoid...).\n\n"
-            "Incolla qui la persona (target, tono, must/avoid,...)."
-        ),
+        placeholder=_PERSONA_PLACEHOLDER,
     )
     toc_text = st.text_area(
         "Table of Contents (simple text paste) / Indice (incolla testo semplice)",
         height=320,
-        placeholder=(
-            "Example / Esempio:\n"
-            "INTRODUCTION\n"
-            "How to Use This Book for Real Impact\n"
-            "A Note on Ethics and Client Safety\n\n"
-            "PART I – FOUNDATIONS\n"
-            "Chapter 1: Understanding the Basics\n"
-            "How X hides in plain sight\n"
-            "The biology of Y\n"
-        ),
+        placeholder=_TOC_PLACEHOLDER,
     )
+    force = st.checkbox("Force regenerate (ignore cached results)", value=False)
     submitted = st.form_submit_button("🚀 Generate", use_container_width=True)
 
 st.button("▶ Reset state", on_click=lambda: st.session_state.update(running=False))
 
+# ---------- TOC preview ----------
+@st.fragment
+def toc_preview(toc_text: str):
+    """Parsed outline of the submitted TOC; toggling reruns only this fragment."""
+    if not toc_text.strip():
+        return
+    if st.toggle("Preview parsed TOC", key="toc_preview"):
+        chapters = parse_toc_lines(toc_text)  # same cache entry Generate uses
+        n_subs = sum(len(subs) for _, subs in chapters)
+        st.caption(f"{len(chapters)} chapters · {n_subs} subsections")
+        st.text("\n".join(
+            f"{t}\n" + "".join(f"  - {s}\n" for s in subs) for t, subs in chapters
+        ))
+
+toc_preview(toc_text)
+
 # ---------- Action ----------
 if submitted:
     if st.session_state.running:
@@ -140,43 +106,71 @@ if submitted:
             st.stop()
 
         # ---- Secrets
-        api_key = st.secrets.get("OPENAI_API_KEY", "")
+        api_key = get_setting("OPENAI_API_KEY")
         if not api_key:
-            st.error("Missing OPENAI_API_KEY in Streamlit Secrets.")
+            st.error("Missing OPENAI_API_KEY (Streamlit Secrets or environment variable).")
             st.info("Streamlit Cloud → Manage app → Settings → Secrets.")
             st.stop()
 
-        # ---- Env
-        os.environ["OPENAI_API_KEY"] = api_key
-        model = st.secrets.get("BOOK_MODEL", "")
-        if model:
-            os.environ["BOOK_MODEL"] = model
-
-        # ---- Build book.yaml
-        run_id = time.strftime("%Y%m%d-%H%M%S")
-        os.environ["BOOK_RUN_ID"] = run_id
-        chapters_parsed = parse_toc_lines(toc_text)
-        write_book_yaml_locally(title, persona, chapters_parsed)
-
-        # ---- Generate
-        with st.spinner("Generating the .docx… this can take a bit for larger TOCs."):
-            bookgen_main = import_bookgen_main()
-            bookgen_main.main()
-
-        # ---- Serve .docx
-        out_path = find_output_doc(title, run_id)
-        if not out_path:
-            st.error("Generation finished but output file was not found. Check logs.")
-            st.stop()
+        model = get_setting("BOOK_MODEL")
 
+        # ---- Same inputs as an earlier run? Serve that book instead.
+        gen_key = generation_key(title, persona, toc_text, model or import_bookgen_main().MODEL)
+        out_path = None if force else st.session_state.get(f"doc_{gen_key}")
+        if not force:
+            out_path = Path(out_path) if out_path and Path(out_path).exists() else cached_output(gen_key)
+        if out_path:
+            st.info("Inputs unchanged since a previous run: serving that book.")
+        else:
+            # ---- Build book.yaml
+            # readable stamp + pid/monotonic suffix: unique across sessions and
+            # across clicks within the same second
+            run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid():x}{time.monotonic_ns() & 0xffff:04x}"
+            chapters_parsed = parse_toc_lines(toc_text)
+
+            # ---- Generate
+            # book.yaml in a per-run tempdir: concurrent sessions never share it
+            with st.spinner("Generating the .docx… this can take a bit for larger TOCs."), \
+                    tempfile.TemporaryDirectory(prefix="bookgen-") as tmpdir:
+                yaml_path = write_book_yaml_locally(title, persona, chapters_parsed, Path(tmpdir) / "book.yaml")
+                bookgen_main = import_bookgen_main()
+                # per-run settings go in as an argument, not via os.environ:
+                # concurrent sessions can't leak keys/run ids into each other
+                run_cfg = {
+                    "openai_api_key": api_key, "model": model, "run_id": run_id, "refresh": force,
+                    "yaml_path": str(yaml_path), "output_dir": str(Path("output").resolve()),
+                }
+                # run off the script thread and poll, so the page keeps updating
+                elapsed = st.empty()
+                t0 = time.monotonic()
+                with ThreadPoolExecutor(max_workers=1) as pool:
+                    fut = pool.submit(bookgen_main.main, run_cfg)
+                    while not fut.done():
+                        elapsed.caption(f"Elapsed: {int(time.monotonic() - t0)}s")
+                        time.sleep(0.5)
+                elapsed.empty()
+                fut.result()  # re-raise anything main() raised
+
+            # ---- Serve .docx
+            out_path = find_output_doc(title, run_id)
+            if not out_path:
+                st.error("Generation finished but output file was not found. Check logs.")
+                st.stop()
+
+            store_cached_output(gen_key, out_path)
+
+        st.session_state[f"doc_{gen_key}"] = str(out_path)
+        st.session_state.last_out_path = str(out_path)
         st.success("Done! Click below to download your book.")
-        st.download_button(
-            label="📥 Download .docx",
-            data=out_path.read_bytes(),
-            file_name=out_path.name,
-            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            use_container_width=True,
-        )
+        # rendered once per run: pass the handle, no cached copy of the bytes
+        with out_path.open("rb") as fh:
+            st.download_button(
+                label="📥 Download .docx",
+                data=fh,
+                file_name=out_path.name,
+                mime=_MIME_DOCX,
+                use_container_width=True,
+            )
         st.caption(f"Saved on server: `{out_path}`")
 
     except Exception as e:
@@ -188,3 +182,24 @@ if submitted:
             st.exception(e)
     finally:
         st.session_state.running = False
+
+# ---------- Last result (survives reruns, e.g. after clicking Download) ----------
+elif st.session_state.get("last_out_path"):
+    last = Path(st.session_state.last_out_path)
+    try:
+        payload = docx_payload(last)  # stat doubles as the existence check
+    except FileNotFoundError:
+        st.session_state.last_out_path = None
+    else:
+        st.download_button(
+            label=f"📥 Download last .docx ({last.name})",
+            data=payload,
+            file_name=last.name,
+            mime=_MIME_DOCX,
+            use_container_width=True,
+        )
+
+# ---------- Warm-up ----------
+# Last statement so the form paints first; the bookgen import (yaml, openai,
+# python-docx) then runs while the user fills it in.
+import_bookgen_main()
@@ -1,35 +1,98 @@
 # bookgen/main.py
-import os, json, re, sys
+import os, json, re, sys, time, math, array, asyncio, hashlib, sqlite3, operator, functools, contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED
+from dataclasses import dataclass, field, replace
 from datetime import datetime
+from xml.sax.saxutils import escape
 from pathlib import Path
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml
+except ImportError:
+    from yaml import SafeLoader
 
 from docx import Document
 from docx.shared import Pt, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING
-from docx.oxml import OxmlElement
+from docx.oxml import OxmlElement, parse_xml
 from docx.oxml.ns import qn
-
-from openai import OpenAI
+from docx.opc.pkgwriter import PackageWriter
+
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+try:
+    from openai import DefaultAioHttpClient  # extra "openai[aiohttp]"
+except ImportError:
+    DefaultAioHttpClient = None
+try:
+    import tiktoken  # opzionale: conteggio esatto dei token del prompt
+except ImportError:
+    tiktoken = None
 
 # ====================== CONFIG ======================
 MODEL                 = os.getenv("BOOK_MODEL", "gpt-4o-mini")
+# modello per le chiamate ausiliarie (angle, summary/plan, fixer): compiti semplici
+AUX_MODEL             = os.getenv("BOOK_AUX_MODEL", "gpt-4o-mini")
 SUBSECTION_TOKENS     = int(os.getenv("SUBSECTION_MAX_OUTPUT_TOKENS", "7000"))
 CHAPTER_TOKENS        = int(os.getenv("CHAPTER_MAX_OUTPUT_TOKENS", "18000"))
 
 # Lunghezze
 TARGET_MIN_WORDS      = 500          # target minimo per sottosezione
-HARD_MIN_WORDS        = 220          # sotto questo: retry sempre
-MAX_TRIES_PER_SUB     = 2
+HARD_MIN_WORDS        = 220          # sotto questo la bozza non si espande: si riscrive
+STREAM_STOP_WORDS     = 600          # sottosezioni in streaming: stop a fine frase oltre questa soglia
+CHAPTER_MAX_WORDS     = 3000         # capitoli senza sottosezioni (prompt: 2000-3000 parole)
+TOKENS_PER_WORD       = 1.4          # stima inglese parole -> token
+# max_output_tokens = parole attese * TOKENS_PER_WORD * margine (tetto: *_MAX_OUTPUT_TOKENS).
+# I modelli reasoning spendono token di ragionamento sullo stesso budget: per loro niente stima
+OUTPUT_SLACK          = float(os.getenv("BOOK_OUTPUT_SLACK", "1.5"))
+REASONING_PREFIXES    = ("o1", "o3", "o4", "gpt-5")
+
+# Concorrenza: richieste OpenAI in volo insieme (RPM/TPM) + retry su 429
+CONCURRENCY           = int(os.getenv("BOOK_CONCURRENCY", "4"))
+# capitoli generati in parallelo (ognuno con la sua memoria)
+CHAPTER_CONCURRENCY   = int(os.getenv("BOOK_CHAPTER_CONCURRENCY", str(CONCURRENCY)))
+# anche le sottosezioni di un capitolo in parallelo (angle + bozza dalla memoria
+# di inizio capitolo, senza catena di memoria tra sottosezioni): più veloce
+SPECULATIVE_SUBS      = os.getenv("BOOK_SPECULATIVE_SUBS", "0") == "1"
+RATE_LIMIT_RETRIES    = 5      # anche per timeout / errori di rete / 5xx
+REQUEST_TIMEOUT       = float(os.getenv("BOOK_REQUEST_TIMEOUT", "180"))   # secondi per richiesta
+# limite token/minuto (prompt + output massimo); 0 = nessun throttling lato client
+TPM_LIMIT             = int(os.getenv("BOOK_TPM", "0"))
+
+# Cache risposte su disco (fuori dalla cwd: sopravvive ai run Streamlit)
+CACHE_DIR             = Path(os.getenv("BOOK_CACHE_DIR") or Path.home() / ".bookgen-cache")
+CACHE_TTL             = 7 * 24 * 3600          # secondi
+USE_CACHE             = os.getenv("BOOK_CACHE", "1") != "0"
+
+# Cache semantica (opt-in) per i prompt ausiliari (angle, memory): prompt quasi
+# identici (coseno >= soglia sugli embedding) riusano la risposta precedente
+SEMANTIC_CACHE        = os.getenv("BOOK_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_THRESHOLD    = float(os.getenv("BOOK_SEMANTIC_THRESHOLD", "0.93"))
+EMBED_MODEL           = "text-embedding-3-small"
+
+# --batch: le bozze passano dalla Batch API (metà prezzo, fino a 24h) e finiscono
+# nella cache risposte; poi il run normale le ritrova lì
+BATCH_POLL_SECONDS    = int(os.getenv("BOOK_BATCH_POLL", "60"))
+
+# Salvataggio: il .docx finale si scrive una volta a fine run; ogni N sottosezioni
+# uno snapshot va in "<nome>.partial.docx" (thread in background)
+SAVE_EVERY            = int(os.getenv("BOOK_SAVE_EVERY", "10"))
 
 # Mini-headings normalization: "bullet" or "bold"
 MINI_MODE = os.getenv("MINI_HEADING_MODE", "bullet").strip().lower()
 
-DOCS_DIR   = Path("output")
-CHECKPOINT = Path("progress.json")
-BOOK_YAML  = Path("book.yaml")
+DOCS_DIR     = Path("output")
+PROGRESS_DIR = ".progress"   # log di ripresa: <output_dir>/.progress/<book_key>.jsonl
+BOOK_YAML    = Path("book.yaml")
+
+def default_run_id() -> str:
+    # only when the caller passes no run_id (CLI); UIs pass their own
+    return os.getenv("BOOK_RUN_ID") or datetime.now().strftime("%Y%m%d-%H%M%S")
 
-RUN_ID = os.getenv("BOOK_RUN_ID") or datetime.now().strftime("%Y%m%d-%H%M%S")
+# filename-unsafe chars -> "-" (kept in sync with bookgen_ui_helpers._BAD_CHARS: find_output_doc relies on it)
+_BAD_CHARS = dict.fromkeys(map(ord, '\\/:*?"<>|'), ord("-"))
 
 # ===== MASTER PROMPT (ASCII only) =====
 MASTER_PROMPT = '''
@@ -52,12 +115,44 @@ Global quality goals:
 '''
 
 # ====================================================
-client = OpenAI()
+# Per-run state: overrides passed to main(config=...) (openai_api_key, model,
+# run_id) plus the run's AsyncOpenAI client and concurrency semaphore.
+# Callers running several books in one process don't have to touch os.environ.
+_RUN_CFG = contextvars.ContextVar("bookgen_run_cfg", default={})
+
+def _http_client():
+    # aiohttp transport holds up better than the default httpx pool under many
+    # concurrent requests; used when the openai[aiohttp] extra is installed
+    if DefaultAioHttpClient is not None:
+        try:
+            return DefaultAioHttpClient()
+        except RuntimeError:  # extra not installed
+            pass
+    return None
+
+def new_client(api_key=None):
+    # created per run, inside its event loop (connection pools are loop-bound).
+    # max_retries=0: with_backoff is the only retry layer
+    kwargs = {"timeout": REQUEST_TIMEOUT, "max_retries": 0}
+    http_client = _http_client()
+    if http_client is not None:
+        kwargs["http_client"] = http_client
+    if api_key:
+        kwargs["api_key"] = api_key
+    return AsyncOpenAI(**kwargs)
 
 # ---------------- File IO ----------------
-def load_yaml(path=BOOK_YAML):
+@functools.lru_cache(maxsize=8)
+def _load_yaml_cached(path: str, mtime_ns: int, size: int):
     with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=SafeLoader)
+
+def load_yaml(path=BOOK_YAML):
+    # parsed once per (path, mtime, size): repeated main() calls in one process
+    # (GUI, Streamlit) skip re-parsing an unchanged file. Treat the result as read-only.
+    p = os.path.abspath(path)
+    st = os.stat(p)
+    return _load_yaml_cached(p, st.st_mtime_ns, st.st_size)
 
 def _set_mirror_margins(doc: Document):
     try:
@@ -69,11 +164,10 @@ def _set_mirror_margins(doc: Document):
     except Exception:
         pass
 
-def ensure_doc(title: str):
-    DOCS_DIR.mkdir(exist_ok=True)
-    safe_title = re.sub(r'[\\/:*?"<>|]+', '-', title).strip()
-    doc_path = DOCS_DIR / f"BOOK - {safe_title} - {RUN_ID}.docx"
-
+@functools.lru_cache(maxsize=1)
+def _base_template() -> bytes:
+    # page setup + styles are the same for every book: build them once per
+    # process and reopen the saved bytes, instead of redoing the setters per run
     doc = Document()
 
     # Page size & margins
@@ -114,14 +208,91 @@ def ensure_doc(title: str):
         except KeyError:
             pass
 
+    buf = BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+def ensure_doc(title: str, run_id: str = None, out_dir: Path = DOCS_DIR):
+    run_id = run_id or default_run_id()
+    out_dir.mkdir(parents=True, exist_ok=True)
+    safe_title = title.translate(_BAD_CHARS).strip()
+    doc_path = out_dir / f"BOOK - {safe_title} - {run_id}.docx"
+
+    doc = Document(BytesIO(_base_template()))
     h0 = doc.add_heading(title, level=0)
     h0.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
 
-    doc.save(str(doc_path))
     return doc, doc_path
 
-def save_doc(doc: Document, path: Path):
-    doc.save(str(path))
+def save_doc(doc: Document, path: str):
+    doc.save(path)
+
+class _StoredZipWriter:
+    # python-docx's zip package writer, minus deflate (per call: no global patching)
+    def __init__(self, file):
+        self._zipf = ZipFile(file, "w", compression=ZIP_STORED)
+
+    def write(self, pack_uri, blob):
+        self._zipf.writestr(pack_uri.membername, blob)
+
+    def close(self):
+        self._zipf.close()
+
+def save_doc_stored(doc: Document, file):
+    """Uncompressed save (to a path or file object): same steps as OpcPackage.save."""
+    pkg = doc.part.package
+    for part in pkg.parts:
+        part.before_marshal()
+    writer = _StoredZipWriter(file)
+    try:
+        PackageWriter._write_content_types_stream(writer, pkg.parts)
+        PackageWriter._write_pkg_rels(writer, pkg.rels)
+        PackageWriter._write_parts(writer, pkg.parts)
+    finally:
+        writer.close()
+
+def checkpoint_doc(io, pending, doc: Document, path: str):
+    """
+    Snapshot doc to path: serialized here (uncompressed, cheaper than a copy of
+    the tree), written on the I/O thread; an older write still queued is dropped.
+    """
+    if pending is not None:
+        pending.cancel()
+    buf = BytesIO()
+    save_doc_stored(doc, buf)
+    return io.submit(Path(path).write_bytes, buf.getvalue())
+
+# Progress log in <output_dir>/.progress/<book_key>.jsonl: a header line with the book fingerprint, then
+# one JSON line per finished chapter. A crashed run of the same book resumes
+# from it; it is removed once the .docx is written.
+def load_progress(path: Path, book_key: str) -> dict:
+    """{chapter index: [(sub, text), ...]} from an interrupted run of the same book."""
+    done = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            if json.loads(next(f)).get("book") != book_key:
+                return {}
+            for line in f:
+                rec = json.loads(line)
+                done[rec["i"]] = [tuple(pair) for pair in rec["pairs"]]
+    except (FileNotFoundError, StopIteration, ValueError, KeyError):
+        pass  # missing file, or a torn last line: keep what parsed
+    return done
+
+def open_progress(path: Path, book_key: str, done: dict):
+    # rewritten with only the records that parsed (via a temp file + replace),
+    # so new lines never follow a torn one that would hide them on the next resume
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"book": book_key}) + "\n")
+        for i, pairs in done.items():
+            f.write(json.dumps({"i": i, "pairs": pairs}, ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+    return open(path, "a", encoding="utf-8")
+
+def log_progress(f, i: int, pairs):
+    f.write(json.dumps({"i": i, "pairs": pairs}, ensure_ascii=False) + "\n")
+    f.flush()
 
 # ---------------- TOC helpers ----------------
 def flatten_toc(toc_list):
@@ -137,9 +308,46 @@ def flatten_toc(toc_list):
             raise ValueError("Invalid TOC item")
     return chapters
 
+# ---------------- Response cache ----------------
+# Completions keyed by (model, max_tokens, prompt) in a small SQLite file that
+# outlives the process: re-running an unchanged book.yaml costs no API calls.
+def open_cache():
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # writes happen on the run's I/O thread, reads on the event loop
+    db = sqlite3.connect(CACHE_DIR / "responses.sqlite", check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)")
+    # semantic rows are scoped by aux model and book; older unscoped rows are dropped
+    if "book" not in {row[1] for row in db.execute("PRAGMA table_info(semantic)")}:
+        db.execute("DROP TABLE IF EXISTS semantic")
+    db.execute("CREATE TABLE IF NOT EXISTS semantic (kind TEXT NOT NULL, model TEXT NOT NULL, book TEXT NOT NULL, "
+               "vec BLOB NOT NULL, text TEXT NOT NULL, created REAL NOT NULL)")
+    db.execute("DELETE FROM responses WHERE created < ?", (time.time() - CACHE_TTL,))
+    db.execute("DELETE FROM semantic WHERE created < ?", (time.time() - CACHE_TTL,))
+    db.commit()
+    return db
+
+def cache_key(model: str, max_tokens: int, prompt: str) -> str:
+    return hashlib.blake2b(f"{model}|{max_tokens}|{prompt}".encode("utf-8"), digest_size=20).hexdigest()
+
+def cache_get(db, key: str):
+    row = db.execute("SELECT text FROM responses WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def cache_put(db, key: str, text: str):
+    db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, text, time.time()))
+    db.commit()
+
+def semantic_put(db, kind: str, model: str, book: str, vec, text: str):
+    db.execute("INSERT INTO semantic VALUES (?, ?, ?, ?, ?, ?)", (kind, model, book, vec.tobytes(), text, time.time()))
+    db.commit()
+
 # ---------------- OpenAI helpers ----------------
 def responses_text(resp):
-    if hasattr(resp, "output") and resp.output:
+    # fast path: the SDK's Responses objects already aggregate the text
+    ot = getattr(resp, "output_text", None)
+    if ot and isinstance(ot, str):
+        return ot.strip()
+    if getattr(resp, "output", None):
         out = []
         for block in resp.output:
             if getattr(block, "type", "") == "message":
@@ -151,23 +359,206 @@ def responses_text(resp):
         txt = "".join(out).strip()
         if txt:
             return txt
-    if getattr(resp, "output_text", None):
-        return resp.output_text.strip()
     if getattr(resp, "choices", None):
         return resp.choices[0].message.content.strip()
     return ""
 
-def call_openai(prompt: str, max_tokens: int) -> str:
-    r = client.responses.create(
-        model=MODEL,
-        input=prompt,
-        max_output_tokens=max_tokens
-    )
-    return responses_text(r)
+def is_reasoning_model(model: str) -> bool:
+    name = model.rsplit("/", 1)[-1].lower()
+    return name.startswith(REASONING_PREFIXES) and "-chat" not in name
+
+def output_budget(max_tokens: int, words: int, model: str = None) -> int:
+    """
+    max_output_tokens sized to the expected words (x OUTPUT_SLACK), capped by the
+    configured max; reasoning models get the full configured max.
+    """
+    model = model or _RUN_CFG.get().get("model") or MODEL
+    if is_reasoning_model(model):
+        return max_tokens
+    return min(max_tokens, int(words * OUTPUT_SLACK * TOKENS_PER_WORD))
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    try:
+        return tiktoken.get_encoding("o200k_base") if tiktoken else None
+    except Exception:  # BPE file not cached and no network
+        return None
+
+def count_tokens(text: str) -> int:
+    enc = _encoding()
+    return len(enc.encode(text)) if enc else len(text) // 4
+
+async def _throttle_tpm(run_cfg, tokens: int):
+    # sliding 60s window of (time, tokens) reserved by requests of this run
+    window = run_cfg["tpm_window"]
+    while True:
+        now = time.monotonic()
+        while window and now - window[0][0] >= 60:
+            window.popleft()
+        if not window or sum(t for _, t in window) + tokens <= TPM_LIMIT:
+            window.append((now, tokens))
+            return
+        await asyncio.sleep(60 - (now - window[0][0]))
+
+def _add_usage(run_cfg, r):
+    usage = getattr(r, "usage", None)
+    if usage is not None:
+        stats = run_cfg["stats"]
+        stats["input"] += usage.input_tokens or 0
+        details = getattr(usage, "input_tokens_details", None)
+        stats["cached"] += getattr(details, "cached_tokens", 0) or 0
+
+async def _stream_text(run_cfg, stop_words: int, **kwargs) -> str:
+    """
+    Stream a response, stopping at END_MARK or at the first sentence end past
+    stop_words words (closing the stream stops generation, and billing).
+    """
+    buf, words = "", 0
+    async with run_cfg["client"].responses.stream(**kwargs) as stream:
+        async for event in stream:
+            if event.type != "response.output_text.delta":
+                continue
+            delta = event.delta
+            if words >= stop_words and delta[:1].isspace() and buf.endswith((".", "!", "?")):
+                return buf
+            buf += delta
+            if END_MARK in buf[-(len(END_MARK) + len(delta)):]:
+                return buf
+            words += delta.count(" ")
+        _add_usage(run_cfg, await stream.get_final_response())
+    return buf.strip()
+
+async def with_backoff(call):
+    """await call(), retrying 429s, timeouts, connection errors and 5xx with exponential backoff."""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            return await call()
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            # quota exhausted is a 429 too, but waiting won't fix it
+            if attempt == RATE_LIMIT_RETRIES or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            # APIConnectionError covers timeouts (APITimeoutError) too
+            await asyncio.sleep(min(2 ** attempt, 60))
+
+async def _request(run_cfg, model: str, prompt: str, max_tokens: int, json_mode: bool = False,
+                   stop_words: int = None) -> str:
+    extra = {"text": {"format": {"type": "json_object"}}} if json_mode else {}
+    if TPM_LIMIT:
+        await _throttle_tpm(run_cfg, count_tokens(prompt) + max_tokens)
+
+    async def once():
+        if stop_words:
+            return await _stream_text(
+                run_cfg, stop_words,
+                model=model, input=prompt, max_output_tokens=max_tokens, **extra
+            )
+        r = await run_cfg["client"].responses.create(
+            model=model,
+            input=prompt,
+            max_output_tokens=max_tokens,
+            **extra
+        )
+        _add_usage(run_cfg, r)
+        return responses_text(r)
+
+    # keep the slot while backing off: slows the whole run down
+    async with run_cfg["sem"]:
+        return await with_backoff(once)
+
+def aux_model() -> str:
+    return _RUN_CFG.get().get("aux_model") or AUX_MODEL
+
+async def call_openai(prompt: str, max_tokens: int, json_mode: bool = False, stop_words: int = None,
+                      model: str = None) -> str:
+    """stop_words: stream and cut at the first sentence end past that many words."""
+    run_cfg = _RUN_CFG.get()
+    model = model or run_cfg.get("model") or MODEL
+    db = run_cfg.get("cache")
+    if db is None:
+        return await _request(run_cfg, model, prompt, max_tokens, json_mode, stop_words)
+    key = cache_key(model, max_tokens, prompt)
+    # refresh skips the cache, except for drafts this run's batch just stored
+    if not run_cfg.get("refresh") or key in run_cfg.get("batched", ()):
+        text = cache_get(db, key)
+        if text is not None:
+            return text
+    text = await _request(run_cfg, model, prompt, max_tokens, json_mode, stop_words)
+    if text:
+        run_cfg["io"].submit(cache_put, db, key, text)
+    return text
+
+async def _embed(run_cfg, text: str):
+    async with run_cfg["sem"]:
+        r = await with_backoff(lambda: run_cfg["client"].embeddings.create(model=EMBED_MODEL, input=text))
+    vec = r.data[0].embedding
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return array.array("f", (x / norm for x in vec))
+
+def _semantic_entries(run_cfg, kind: str):
+    # this book + aux model only; loaded from SQLite once per run, then kept in memory
+    entries = run_cfg["semantic"].get(kind)
+    if entries is None:
+        entries = []
+        rows = run_cfg["cache"].execute(
+            "SELECT vec, text FROM semantic WHERE kind = ? AND model = ? AND book = ?",
+            (kind, aux_model(), run_cfg.get("book_key") or ""),
+        )
+        for blob, text in rows:
+            vec = array.array("f")
+            vec.frombytes(blob)
+            entries.append((vec, text))
+        run_cfg["semantic"][kind] = entries
+    return entries
+
+async def call_openai_aux(kind: str, prompt: str, max_tokens: int, json_mode: bool = False,
+                          match_text: str = None) -> str:
+    """
+    call_openai for auxiliary prompts; may reuse the answer of an earlier prompt
+    whose match_text (the variable part of the prompt) is near-identical.
+    """
+    run_cfg = _RUN_CFG.get()
+    if not SEMANTIC_CACHE or run_cfg.get("cache") is None or run_cfg.get("refresh"):
+        return await call_openai(prompt, max_tokens, json_mode, model=aux_model())
+
+    # exact hit first: an unchanged re-run needs no embedding requests
+    text = cache_get(run_cfg["cache"], cache_key(aux_model(), max_tokens, prompt))
+    if text is not None:
+        return text
+
+    vec = await _embed(run_cfg, match_text or prompt)
+    entries = _semantic_entries(run_cfg, kind)
+    best_sim, best_text = -1.0, None
+    for other, text in entries:  # unit vectors: dot product == cosine
+        sim = sum(map(operator.mul, vec, other))
+        if sim > best_sim:
+            best_sim, best_text = sim, text
+    if best_sim >= SEMANTIC_THRESHOLD:
+        return best_text
+
+    text = await call_openai(prompt, max_tokens, json_mode, model=aux_model())
+    if text:
+        entries.append((vec, text))
+        run_cfg["io"].submit(semantic_put, run_cfg["cache"], kind, aux_model(),
+                             run_cfg.get("book_key") or "", vec, text)
+    return text
 
 # ---------------- Memory (summary + claims + angle) ----------------
-def build_angle(chapter: str, sub: str, rolling_summary: str, claims: list):
-    clist = "\n".join(f"- {c}" for c in (claims or [])[:7]) or "- (none)"
+@dataclass(frozen=True, slots=True)
+class Memory:
+    """Rolling context for the next prompts; claims_bullets is rendered once per update."""
+    summary: str = ""
+    claims: tuple = ()
+    angle: str = ""
+    angles: dict = field(default_factory=dict)  # next subheading -> planned angle
+    claims_bullets: str = "- (none)"
+
+    @classmethod
+    def of(cls, summary: str, claims, angles=None):
+        claims = tuple(claims)[:7]
+        bullets = "\n".join(f"- {c}" for c in claims) or "- (none)"
+        return cls(summary, claims, "", angles or {}, bullets)
+
+async def build_angle(chapter: str, sub: str, mem: Memory):
     prompt = f'''
 You are a content planner.
 Given the rolling summary and the covered claims, propose ONE new angle (max 25 words) for the NEXT section.
@@ -177,46 +568,51 @@ CHAPTER: {chapter}
 SUBHEADING: {sub}
 
 ROLLING SUMMARY:
-{rolling_summary or "(none)"}
+{mem.summary or "(none)"}
 
 COVERED CLAIMS:
-{clist}
+{mem.claims_bullets}
 
 Return one sentence only.
 '''
-    out = call_openai(prompt, 400) or ""
+    # matched on the variable part only: the template would dominate the embedding
+    match = f"{chapter}\n{sub}\n{mem.summary}\n{mem.claims_bullets}"
+    out = await call_openai_aux("angle", prompt, 400, match_text=match) or ""
     return out.splitlines()[0].strip()
 
-def update_memory_from_text(text: str, mem: dict):
+# One round-trip instead of two: the memory update for the section just written
+# also plans the angle of the next subheading(s) (build_angle is only the
+# fallback, e.g. for a chapter's first subheading).
+async def summarize_and_plan(text: str, mem: Memory, next_chapter: str = None, next_subs=()):
+    subs_list = "\n".join(f"- {s}" for s in next_subs) or "- (none)"
     prompt = f'''
-Summarize the following section in 120-180 words (plain, non-marketing), then list 5 KEY CLAIMS as standalone sentences.
+Summarize the section below in 120-180 words (plain, non-marketing), then list 5 KEY CLAIMS as standalone sentences.
+For each NEXT SUBHEADING, propose ONE new angle (max 25 words) not covered by the claims. Do not restate the subheading. Be specific.
 
-SECTION:
-{text}
+Return a JSON object only:
+{{"summary": "<one paragraph 120-180 words>", "claims": ["<sentence 1>", "<sentence 2>", "<sentence 3>", "<sentence 4>", "<sentence 5>"], "next_angles": {{"<subheading>": "<one sentence>"}}}}
 
-Format:
-SUMMARY:
-<one paragraph 120-180 words>
+NEXT CHAPTER: {next_chapter or "(none)"}
+NEXT SUBHEADINGS:
+{subs_list}
 
-CLAIMS:
-- <sentence 1>
-- <sentence 2>
-- <sentence 3>
-- <sentence 4>
-- <sentence 5>
+SECTION:
+{text}
 '''
-    out = call_openai(prompt, 1200) or ""
-    summary, claims = "", []
-    m = re.search(r"SUMMARY:\s*([\s\S]*?)\n\s*CLAIMS:", out, re.I)
-    if m:
-        summary = m.group(1).strip()
-    tail = re.split(r"CLAIMS:\s*", out, flags=re.I)
-    if len(tail) > 1:
-        claims = [re.sub(r"^-+\s*", "", ln).strip()
-                  for ln in tail[1].splitlines() if ln.strip()]
-    mem["summary"] = summary or mem.get("summary", "")
-    mem["claims"]  = (claims or mem.get("claims", []))[:7]
-    return mem
+    match = f"{next_chapter}\n{subs_list}\n{text}"
+    out = await call_openai_aux("plan", prompt, 1200 + 80 * len(next_subs), json_mode=True,
+                                match_text=match) or ""
+    try:
+        data = json.loads(out)
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    summary = str(data.get("summary") or "").strip()
+    claims = [str(c).strip() for c in (data.get("claims") or []) if str(c).strip()]
+    angles = data.get("next_angles")
+    angles = {str(k).strip(): str(v).strip() for k, v in angles.items() if v} if isinstance(angles, dict) else {}
+    return Memory.of(summary or mem.summary, claims or mem.claims, angles)
 
 # ---------------- Prompt builders ----------------
 END_MARK = "<<<END_OF_SUBHEADING>>>"
@@ -230,8 +626,11 @@ STYLE CONTRACT (MANDATORY):
 - If a sentence sounds formal or academic, rewrite it to be friendly and clear.
 '''
 
-def subheading_prompt(master, persona, title, chapters_list, chapter, sub, mem):
-    claims_list = "\n".join(f"- {c}" for c in (mem.get("claims") or [])[:7]) or "- (none)"
+# Static blocks (style, persona, master, title, chapter list) come first and
+# are identical for every call of a run, so OpenAI's automatic prompt caching
+# can reuse that prefix; per-call memory/angle/subheading go last.
+def static_context(master, persona, title, chapters_list) -> str:
+    """The run-wide prompt prefix, formatted once per run."""
     return f'''
 {STYLE_CONTRACT}
 
@@ -241,47 +640,37 @@ BUYER PERSONA (DO NOT OUTPUT):
 MASTER GUIDELINES (DO NOT OUTPUT):
 {master}
 
-CONTEXT SUMMARY (DO NOT OUTPUT):
-{mem.get("summary") or "(none)"}
-
-ALREADY COVERED CLAIMS (avoid repeating; add a new angle if similar):
-{claims_list}
-
-ANGLE TO ADOPT (one sentence):
-{mem.get("angle") or "Bring a new, concrete angle with specific examples."}
-
 BOOK CONTEXT:
 Title: {title}
 
 GLOBAL CHAPTER LIST:
 {chapters_list}
+'''
+
+def subheading_prompt(static: str, chapter, sub, mem: Memory):
+    return f'''{static}
+CONTEXT SUMMARY (DO NOT OUTPUT):
+{mem.summary or "(none)"}
+
+ALREADY COVERED CLAIMS (avoid repeating; add a new angle if similar):
+{mem.claims_bullets}
+
+ANGLE TO ADOPT (one sentence):
+{mem.angle or "Bring a new, concrete angle with specific examples."}
 
 CURRENT CHAPTER: {chapter}
 CURRENT SUBHEADING: {sub}
 
 OUTPUT:
 - Write about 500-600 words of flowing, specific prose for THIS subheading only.
+- You MUST write at least 500 words; count them before ending.
 - Do not restate the heading line in the body.
 - Do not insert new headings.
 - End cleanly with prose, then print exactly this token on a new line: {END_MARK}
 '''
 
-def chapter_only_prompt(master, persona, title, chapters_list, chapter):
-    return f'''
-{STYLE_CONTRACT}
-
-BUYER PERSONA (DO NOT OUTPUT):
-{persona}
-
-MASTER GUIDELINES (DO NOT OUTPUT):
-{master}
-
-BOOK CONTEXT:
-Title: {title}
-
-GLOBAL CHAPTER LIST:
-{chapters_list}
-
+def chapter_only_prompt(static: str, chapter):
+    return f'''{static}
 CURRENT CHAPTER (no subheadings): {chapter}
 
 OUTPUT:
@@ -291,44 +680,70 @@ OUTPUT:
 '''
 
 # ---------------- Output cleaning/formatting ----------------
-BULLET_RE = re.compile(r"^(\s*)[-*•]\s+", re.MULTILINE)
+# markdown heading (+ a bullet right after it, as the old heading-then-bullet
+# passes did) | bullet marker, stripped in one pass by clean_text
+_CLEAN_RE = re.compile(
+    r"(?P<head>^#{2,3}\s+(?:[-*•]\s+)?)|(?P<bul>^(\s*)[-*•]\s+)",
+    re.MULTILINE,
+)
+_MD_HEAD_RE        = re.compile(r"^#{2,3}\s+", re.MULTILINE)
+_FULL_BOLD_RE      = re.compile(r"^\*\*([^*].*[^*])\*\*$")
+_CHAPTER_DAY_RE    = re.compile(r"^(chapter|day)\s+\d+:", re.I)
+_CAMEL_WORD_RE     = re.compile(r"^[A-Z][a-z]+$")
+_BOLD_SPLIT_RE     = re.compile(r"(\*\*)")
+_SENT_SPLIT_RE     = re.compile(r"(?<=[.!?])\s+")
+
+def _clean_repl(m) -> str:
+    return (m.group(3) or "") if m.lastgroup == "bul" else ""
+
+def _strip_astral(s: str) -> str:
+    # emoji (basic): astral-plane chars. isascii()/max() run in C and the
+    # common case (no emoji) returns s untouched
+    if s.isascii() or max(s) < "\U00010000":
+        return s
+    return "".join(c for c in s if c < "\U00010000")
+
+# ASCII letter / uppercase counting on bytes, all in C (bytes.translate deletes)
+_ASCII_UPPER      = bytes(range(65, 91))
+_ASCII_NON_LETTER = bytes(c for c in range(256) if not (65 <= c <= 90 or 97 <= c <= 122))
+
+# bound methods for the per-line calls
+_full_bold  = _FULL_BOLD_RE.match
+_camel_word = _CAMEL_WORD_RE.match
 
 def clean_text(raw: str) -> str:
     if not raw:
         return ""
     text = raw.replace(END_MARK, "").strip()
-    # strip emoji (basic)
-    text = re.sub(r"[\U00010000-\U0010FFFF]", "", text)
-    # strip markdown headings
-    text = re.sub(r"^#{2,3}\s+", "", text, flags=re.MULTILINE)
-    # lists -> paragraphs
-    text = BULLET_RE.sub(r"\\1", text)
+    # strip emoji (basic) and markdown headings; lists -> paragraphs (keep indent)
+    text = _CLEAN_RE.sub(_clean_repl, _strip_astral(text))
 
     # drop all-caps lines; unwrap full-bold lines
     lines = []
     for ln in text.splitlines():
         t = ln.rstrip()
-        letters = re.sub(r"[^A-Za-z]+", "", t)
-        upper_ratio = (sum(1 for ch in letters if ch.isupper()) / len(letters)) if letters else 0
+        letters = t.encode("ascii", "ignore").translate(None, _ASCII_NON_LETTER)
+        n_upper = len(letters) - len(letters.translate(None, _ASCII_UPPER))
+        upper_ratio = (n_upper / len(letters)) if letters else 0
         if upper_ratio > 0.6 and len(t) > 8:
             continue
-        if re.match(r"^\\*\\*[^*].*[^*]\\*\\*$", t):
-            t = re.sub(r"^\\*\\*(.*)\\*\\*$", r"\\1", t)
-        lines.append(t)
-    return "\\n".join(lines).strip()
+        m = _full_bold(t)
+        lines.append(m.group(1) if m else t)
+    return "\n".join(lines).strip()
 
 def is_probable_mini_heading(line: str) -> bool:
-    t = line.strip()
-    if not t or len(t.split()) < 2 or len(t.split()) > 7:
+    # plain str checks first; only the per-word test is a (bound) regex match
+    words = line.split()
+    if not 2 <= len(words) <= 7:
         return False
-    if re.search(r"[.!?]$", t):
+    if words[-1][-1] in ".!?" or words[0][0].isdecimal():
         return False
-    if re.match(r"^(chapter|day)\\s+\\d+:", t, flags=re.I):
-        return False
-    if re.match(r"^\\d", t):
-        return False
-    words = t.split()
-    caps = sum(1 for w in words if re.match(r"^[A-Z][a-z]+$", w))
+    # "Chapter 3: ..." / "Day 12: ..."
+    if words[0].lower() in ("chapter", "day"):
+        num, colon, _ = words[1].partition(":")
+        if colon and num.isdecimal():
+            return False
+    caps = sum(1 for w in words if _camel_word(w))
     return (caps / len(words)) >= 0.6
 
 def normalize_mini_headings(text: str) -> str:
@@ -350,10 +765,10 @@ def normalize_mini_headings(text: str) -> str:
             continue
         out.append(lines[i])
         i += 1
-    return "\\n".join(out)
+    return "\n".join(out)
 
 def split_into_paragraphs_preserving_bold(line: str):
-    parts = re.split(r"(\\*\\*)", line)
+    parts = _BOLD_SPLIT_RE.split(line)
     result_spans, bold = [], False
     for part in parts:
         if part == "**":
@@ -368,49 +783,77 @@ def split_into_paragraphs_preserving_bold(line: str):
             result_spans.append((bold, part))
     return result_spans
 
+# Body paragraphs as raw WordprocessingML, same markup python-docx produced for
+# add_paragraph + add_run (justified, 0/6pt spacing, 1.2 lines, Cambria 13):
+# one parse per subsection instead of many lxml calls per run.
+_W_NS    = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_P_OPEN  = ('<w:p><w:pPr><w:spacing w:before="0" w:after="120" w:lineRule="auto" w:line="288"/>'
+            '<w:jc w:val="both"/></w:pPr>')
+_R_OPEN  = ('<w:r><w:rPr><w:rFonts w:ascii="Cambria" w:hAnsi="Cambria"/>{}'
+            '<w:sz w:val="26"/></w:rPr><w:t xml:space="preserve">')
+_R_PLAIN = _R_OPEN.format('<w:b w:val="0"/>')
+_R_BOLD  = _R_OPEN.format("<w:b/>")
+
+def paragraph_xml(text: str) -> str:
+    runs = "".join(
+        f"{_R_BOLD if is_bold else _R_PLAIN}{escape(chunk)}</w:t></w:r>"
+        for is_bold, chunk in split_into_paragraphs_preserving_bold(text)
+    )
+    return f"{_P_OPEN}{runs}</w:p>"
+
+def append_paragraphs(doc: Document, paras_xml: list):
+    if not paras_xml:
+        return
+    frag = parse_xml(f'<w:body xmlns:w="{_W_NS}">{"".join(paras_xml)}</w:body>')
+    body = doc.element.body
+    sect_pr = body.sectPr  # paragraphs go before the final section properties
+    # one slice assignment moves the whole batch in a single lxml call
+    at = body.index(sect_pr) if sect_pr is not None else len(body)
+    body[at:at] = list(frag)
+
 def add_paragraph_with_bold(doc: Document, text: str):
-    p = doc.add_paragraph()
-    p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-    fmt = p.paragraph_format
-    fmt.space_before = Pt(0)
-    fmt.space_after  = Pt(6)
-    fmt.line_spacing_rule = WD_LINE_SPACING.MULTIPLE
-    fmt.line_spacing = 1.2
-
-    spans = split_into_paragraphs_preserving_bold(text)
-    for is_bold, chunk in spans:
-        run = p.add_run(chunk)
-        run.font.name = "Cambria"
-        run.font.size = Pt(13)
-        run.bold = bool(is_bold)
+    append_paragraphs(doc, [paragraph_xml(text)])
 
 def write_subsection(doc: Document, body_text: str):
     body_text = normalize_mini_headings(body_text)
 
-    for para in body_text.split("\\n"):
+    paras = []
+    for para in body_text.splitlines():
         t = para.strip()
         if not t:
             continue
-        if len(t.split()) > 180:
-            for chunk in re.split(r"(?<=[.!?])\\s+", t):
+        if t.count(" ") >= 180:  # > 180 words, without building the word list
+            for chunk in _SENT_SPLIT_RE.split(t):
                 if chunk.strip():
-                    add_paragraph_with_bold(doc, chunk.strip())
+                    paras.append(paragraph_xml(chunk.strip()))
         else:
-            add_paragraph_with_bold(doc, t)
+            paras.append(paragraph_xml(t))
+    append_paragraphs(doc, paras)
 
 # ---------------- Light fixer ----------------
-def quick_validate_and_fix(text: str, covered_claims: list, angle: str):
-    issues = []
-    if re.search(r"^#{2,3}\\s+", text, flags=re.M):
-        issues.append("Markdown headings inside body.")
-    if re.search(r"^[A-Z0-9][A-Z0-9\\s.,;:!?\"'()\\\\-]{20,}$", text, flags=re.M):
-        issues.append("All-caps paragraph detected.")
-    for c in (covered_claims or []):
-        if c and len(c) > 8 and c.lower() in text.lower():
-            issues.append("Repeats a previously stated claim too literally.")
-
-    if not issues:
+CLAIM_OVERLAP_WORDS = 15  # verbatim run of a claim that counts as a repeat
+
+def repeats_claim(text: str, covered_claims) -> bool:
+    # a run of CLAIM_OVERLAP_WORDS consecutive words of a claim (or the whole
+    # claim, if shorter but >= 8 words) found verbatim; short common phrases don't count
+    norm = " " + " ".join(text.lower().split()) + " "
+    for c in covered_claims or ():
+        words = c.lower().split()
+        n = min(CLAIM_OVERLAP_WORDS, len(words))
+        if n < 8:
+            continue
+        for i in range(len(words) - n + 1):
+            if " " + " ".join(words[i:i + n]) + " " in norm:
+                return True
+    return False
+
+async def quick_validate_and_fix(text: str, covered_claims: list, angle: str):
+    # headings are stripped locally (all-caps lines are already gone:
+    # clean_text drops them); only a repeated claim needs the copy editor
+    text = _MD_HEAD_RE.sub("", text)
+    if not repeats_claim(text, covered_claims):
         return text
+    issues = ["Repeats a previously stated claim too literally."]
 
     prompt = f'''
 You are a copy editor. Fix the issues MINIMALLY without changing meaning or tone.
@@ -430,101 +873,294 @@ RULES:
 - Start with prose (do not echo the heading).
 - Return ONLY the cleaned text.
 '''
-    fixed = call_openai(prompt, 1800) or text
+    fixed = await call_openai(prompt, 1800, model=aux_model()) or text
     return clean_text(fixed)
 
 # ---------------- MAIN ----------------
-def main():
-    # start clean
-    if CHECKPOINT.exists():
-        CHECKPOINT.unlink()
+def _drop_echo(cleaned: str, chapter: str, sub: str) -> str:
+    # Echo filter (light): drop lines that just repeat the chapter/subheading
+    n_ch  = chapter.strip().lower()
+    n_sub = sub.strip().lower()
+    lines = cleaned.splitlines()
+    if not any(len(ln.split()) > 5 for ln in lines):
+        return cleaned
+    return "\n".join(
+        ln for ln in lines
+        if ln.strip().lower() not in (n_ch, n_sub)
+        and not _CHAPTER_DAY_RE.match(ln.strip())
+    )
 
-    if not BOOK_YAML.exists():
-        print(f"Missing {BOOK_YAML.resolve()}")
+async def generate_sub(static, chapter, sub, mem):
+    """Angle + draft (expanded once if short) + light fix for one subheading."""
+    angle = mem.angles.get(sub.strip())
+    if not angle and not _RUN_CFG.get().get("batch"):
+        angle = await build_angle(chapter, sub, mem)
+    mem = replace(mem, angle=angle)
+
+    prompt = subheading_prompt(static, chapter, sub, mem)
+    budget = output_budget(SUBSECTION_TOKENS, STREAM_STOP_WORDS)
+    raw = await call_openai(prompt, budget, stop_words=STREAM_STOP_WORDS)
+    out_text = _drop_echo(clean_text(raw), chapter, sub)
+    n_words = len(out_text.split())
+
+    if n_words < TARGET_MIN_WORDS:
+        # one regeneration: same prompt (cached prefix) + the short draft to expand
+        draft = f"PREVIOUS DRAFT (expand it, keep what works):\n{out_text}\n" if n_words >= HARD_MIN_WORDS else ""
+        force_prompt = f"""{prompt}
+IMPORTANT:
+- Your previous draft was too short ({n_words} words). Produce a complete 600 words now.
+- Keep everything extremely simple, friendly, and concrete. No jargon.
+- Do NOT insert headings. Prose only.
+{draft}"""
+        raw = await call_openai(force_prompt, budget, stop_words=STREAM_STOP_WORDS)
+        longer = _drop_echo(clean_text(raw), chapter, sub)
+        if len(longer.split()) > n_words:
+            out_text = longer
+
+    return await quick_validate_and_fix(out_text, mem.claims, angle=mem.angle)
+
+async def generate_chapter(static, ch, chapter_sem):
+    """
+    [(subheading, text), ...] for one chapter ([(None, text)] if it has no subs).
+    Memory chains through the chapter's own subheadings only, so chapters can
+    run concurrently; the TOC in every prompt keeps them aware of each other.
+    """
+    async with chapter_sem:
+        mem = Memory()
+        if not ch["subs"]:
+            prompt = chapter_only_prompt(static, ch["title"])
+            # streamed like the subsections: stops at END_MARK, or past the word cap
+            raw = await call_openai(prompt, output_budget(CHAPTER_TOKENS, CHAPTER_MAX_WORDS),
+                                    stop_words=CHAPTER_MAX_WORDS)
+            fixed = await quick_validate_and_fix(clean_text(raw), mem.claims, angle=None)
+            return [(None, fixed)]
+
+        subs = ch["subs"]
+        if SPECULATIVE_SUBS or _RUN_CFG.get().get("batch"):
+            texts = await asyncio.gather(*(
+                generate_sub(static, ch["title"], sub, mem) for sub in subs
+            ))
+            return list(zip(subs, texts))
+
+        # Memory lags one sub behind: the summary of sub j runs while sub j+1
+        # drafts and feeds sub j+2 (planning its angle). Only the first summary
+        # is awaited inline; it plans the next two subs to prime the pipeline.
+        out, pending = [], None
+        try:
+            for j, sub in enumerate(subs):
+                fixed = await generate_sub(static, ch["title"], sub, mem)
+                out.append((sub, fixed))
+                if pending is not None:
+                    mem, pending = await pending, None
+                if j == 0 and len(subs) > 1:
+                    mem = await summarize_and_plan(fixed, mem, ch["title"], subs[1:3])
+                elif j + 2 < len(subs):
+                    pending = asyncio.create_task(
+                        summarize_and_plan(fixed, mem, ch["title"], subs[j + 2:j + 3])
+                    )
+        finally:
+            if pending is not None:
+                pending.cancel()
+        return out
+
+def batch_requests(static, chapters, skip=()):
+    """(cache key, /v1/responses body) for every first draft: memory-free prompts, no angle."""
+    model = _RUN_CFG.get().get("model") or MODEL
+    for i, ch in enumerate(chapters):
+        if i in skip:
+            continue
+        if ch["subs"]:
+            budget = output_budget(SUBSECTION_TOKENS, STREAM_STOP_WORDS, model)
+            prompts = [subheading_prompt(static, ch["title"], sub, Memory()) for sub in ch["subs"]]
+        else:
+            budget = output_budget(CHAPTER_TOKENS, CHAPTER_MAX_WORDS, model)
+            prompts = [chapter_only_prompt(static, ch["title"])]
+        for prompt in prompts:
+            body = {"model": model, "input": prompt, "max_output_tokens": budget}
+            yield cache_key(model, budget, prompt), body
+
+def batch_body_text(body: dict) -> str:
+    # raw Responses JSON from the batch output file (not parsed by the SDK)
+    return "".join(
+        c.get("text") or ""
+        for block in body.get("output") or ()
+        if block.get("type") == "message"
+        for c in block.get("content") or ()
+        if c.get("type") == "output_text"
+    ).strip()
+
+async def prefetch_batch(static, chapters, skip=()):
+    """
+    Send the drafts not already cached as one Batch API job, wait for it and
+    store the results in the response cache. Rows that fail are simply left
+    to the normal (live) requests.
+    """
+    run_cfg = _RUN_CFG.get()
+    client, db, io = run_cfg["client"], run_cfg["cache"], run_cfg["io"]
+    rows = {}
+    for key, body in batch_requests(static, chapters, skip):
+        if run_cfg.get("refresh") or cache_get(db, key) is None:
+            rows[key] = {"custom_id": key, "method": "POST", "url": "/v1/responses", "body": body}
+    if not rows:
+        return
+
+    data = "\n".join(json.dumps(r) for r in rows.values()).encode("utf-8")
+    f = await with_backoff(lambda: client.files.create(file=("batch_input.jsonl", data), purpose="batch"))
+    batch = await with_backoff(lambda: client.batches.create(
+        input_file_id=f.id, endpoint="/v1/responses", completion_window="24h"
+    ))
+    print(f"Batch {batch.id}: {len(rows)} draft(s) submitted")
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await with_backoff(lambda: client.batches.retrieve(batch.id))
+    # expired batches still return the rows they finished
+    if not batch.output_file_id:
+        print(f"Batch {batch.id} {batch.status}: drafting live")
+        return
+
+    content = await with_backoff(lambda: client.files.content(batch.output_file_id))
+    stored, last = 0, None
+    stats = run_cfg["stats"]
+    for line in content.text.splitlines():
+        # one bad row must not cost the rest of the batch: it is drafted live
+        try:
+            row = json.loads(line)
+            resp = row.get("response") or {}
+            if row.get("custom_id") not in rows or resp.get("status_code") != 200:
+                continue
+            body = resp["body"]
+            text = batch_body_text(body)
+            usage = body.get("usage") or {}
+            stats["input"] += usage.get("input_tokens") or 0
+            stats["cached"] += (usage.get("input_tokens_details") or {}).get("cached_tokens") or 0
+        except (ValueError, TypeError, AttributeError, KeyError):
+            continue
+        if text:
+            last = io.submit(cache_put, db, row["custom_id"], text)
+            run_cfg["batched"].add(row["custom_id"])
+            stored += 1
+    if last is not None:
+        await asyncio.wrap_future(last)  # serial thread: every row is in
+    print(f"Batch {batch.id} {batch.status}: {stored}/{len(rows)} draft(s) cached")
+
+async def _generate(config, title, persona, chapters, progress):
+    cache = open_cache() if USE_CACHE else None
+    # one serial thread for the run's disk writes (cache rows, progress log,
+    # partial snapshots): they overlap the network waits instead of blocking the loop
+    io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bookgen-io")
+    try:
+        return await _generate_with(config, title, persona, chapters, cache, progress, io)
+    finally:
+        io.shutdown(wait=True)
+        if cache is not None:
+            cache.close()
+
+async def _generate_with(config, title, persona, chapters, cache, progress, io):
+    progress_path, book_key, done = progress
+    async with new_client(config.get("openai_api_key")) as client:
+        stats = {"input": 0, "cached": 0}  # prompt-cache hit rate, printed at the end
+        _RUN_CFG.set({
+            **config, "client": client, "sem": asyncio.Semaphore(CONCURRENCY),
+            "stats": stats, "cache": cache, "semantic": {}, "tpm_window": deque(), "io": io,
+            "book_key": book_key, "batched": set(),
+        })
+
+        doc, doc_path = ensure_doc(title, config.get("run_id"), Path(config.get("output_dir") or DOCS_DIR))
+        partial_path = doc_path.with_suffix(".partial.docx")
+        doc_file, partial_file = str(doc_path), str(partial_path)  # stringified once
+        pending = None
+        written = last_checkpoint = 0
+
+        chapters_list = "\n".join(f"- {c['title']}" for c in chapters)
+        static = static_context(MASTER_PROMPT, persona, title, chapters_list)
+        chapter_sem = asyncio.Semaphore(CHAPTER_CONCURRENCY)
+        if config.get("batch"):
+            await prefetch_batch(static, chapters, skip=done)
+
+        # All chapters start at once (except those restored from the progress
+        # log); the doc is assembled in TOC order as soon as each chapter (and
+        # every one before it) is done.
+        tasks = [
+            None if i in done else
+            asyncio.create_task(generate_chapter(static, ch, chapter_sem))
+            for i, ch in enumerate(chapters)
+        ]
+        log = open_progress(progress_path, book_key, done)
+        try:
+            for i, (ch, task) in enumerate(zip(chapters, tasks)):
+                h = doc.add_heading(ch["title"], level=1)
+                h.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+                if task is None:
+                    pairs = done[i]
+                else:
+                    pairs = await task
+                    io.submit(log_progress, log, i, pairs)
+                for sub, fixed in pairs:
+                    if sub is not None:
+                        sh = doc.add_heading(sub, level=2)
+                        sh.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+                    write_subsection(doc, fixed)
+                    written += 1
+
+                if written - last_checkpoint >= SAVE_EVERY:
+                    pending = checkpoint_doc(io, pending, doc, partial_file)
+                    last_checkpoint = written
+        finally:
+            tasks = [t for t in tasks if t is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # queued after every pending log line / snapshot: waits for all of them
+            await asyncio.wrap_future(io.submit(log.close))
+
+        await asyncio.wrap_future(io.submit(save_doc, doc, doc_file))
+        partial_path.unlink(missing_ok=True)
+        progress_path.unlink(missing_ok=True)
+    if stats["input"]:
+        print(f"Prompt cache: {stats['cached']}/{stats['input']} input tokens cached")
+    return doc_path
+
+def main(config=None):
+    """
+    Generate the book described by book.yaml in the cwd.
+    config: optional dict overriding openai_api_key / model / aux_model / run_id
+    for this call only (defaults come from the environment); refresh=True
+    skips cached responses (fresh ones are still stored). yaml_path and
+    output_dir replace ./book.yaml and ./output, so callers need no chdir.
+    An interrupted run of the same book resumes from its progress log
+    (refresh=True starts clean). batch=True (CLI: --batch) drafts through
+    the Batch API first: half the price, no memory chain, up to 24h wait.
+    """
+    config = config or {}
+    yaml_path = Path(config.get("yaml_path") or BOOK_YAML)
+
+    if not yaml_path.exists():
+        print(f"Missing {yaml_path.resolve()}")
+        sys.exit(1)
+    if config.get("batch") and not USE_CACHE:
+        print("--batch needs the response cache (BOOK_CACHE=1)")
         sys.exit(1)
 
-    cfg = load_yaml(BOOK_YAML)
+    book_key = hashlib.blake2b(
+        yaml_path.read_bytes() + (config.get("model") or MODEL).encode(), digest_size=16
+    ).hexdigest()
+    # next to the output, not book.yaml: the web UI writes that to a temp dir
+    checkpoint = Path(config.get("output_dir") or DOCS_DIR) / PROGRESS_DIR / f"{book_key}.jsonl"
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    done = {} if config.get("refresh") else load_progress(checkpoint, book_key)
+    if done:
+        print(f"Resuming: {len(done)} chapter(s) restored from {checkpoint}")
+
+    cfg = load_yaml(yaml_path)
     title   = cfg["title"]
     persona = cfg["persona"]
     chapters = flatten_toc(cfg["toc"])
 
-    doc, doc_path = ensure_doc(title)
-
-    # memory
-    mem = {"summary": "", "claims": []}
-    chapters_list = "\\n".join(f"- {c['title']}" for c in chapters)
-
-    for ch in chapters:
-        h = doc.add_heading(ch["title"], level=1)
-        h.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-
-        if not ch["subs"]:
-            prompt = chapter_only_prompt(MASTER_PROMPT, persona, title, chapters_list, ch["title"])
-            raw = call_openai(prompt, CHAPTER_TOKENS)
-            cleaned = clean_text(raw)
-            fixed = quick_validate_and_fix(cleaned, mem.get("claims"), angle=None)
-            write_subsection(doc, fixed)
-            mem = update_memory_from_text(fixed, mem)
-            save_doc(doc, doc_path)
-            continue
-
-        for sub in ch["subs"]:
-            sh = doc.add_heading(sub, level=2)
-            sh.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-
-            mem["angle"] = build_angle(ch["title"], sub, mem.get("summary"), mem.get("claims"))
-
-            tries, out_text = 0, ""
-            while tries < MAX_TRIES_PER_SUB:
-                prompt = subheading_prompt(MASTER_PROMPT, persona, title, chapters_list, ch["title"], sub, mem)
-                raw = call_openai(prompt, SUBSECTION_TOKENS)
-                cleaned = clean_text(raw)
-
-                # Echo filter (light)
-                n_ch  = ch["title"].strip().lower()
-                n_sub = sub.strip().lower()
-                lines = cleaned.splitlines()
-                has_real_prose = any(len(ln.split()) > 5 for ln in lines)
-                if has_real_prose:
-                    cleaned = "\\n".join(
-                        ln for ln in lines
-                        if ln.strip().lower() not in (n_ch, n_sub)
-                        and not re.match(r"^(chapter|day)\\s+\\d+:", ln.strip(), flags=re.I)
-                    )
-
-                # hard guard
-                if len(cleaned.split()) < HARD_MIN_WORDS:
-                    cleaned = ""
-
-                if cleaned and len(cleaned.split()) >= TARGET_MIN_WORDS:
-                    out_text = cleaned
-                    break
-
-                tries += 1
-
-            if not out_text:
-                # force expansion
-                force_prompt = f"""{subheading_prompt(MASTER_PROMPT, persona, title, chapters_list, ch["title"], sub, mem)}
-IMPORTANT:
-- Previous attempt was too short. Produce a complete 500-600 words now.
-- Keep everything extremely simple, friendly, and concrete. No jargon.
-- Do NOT insert headings. Prose only.
-"""
-                raw = call_openai(force_prompt, SUBSECTION_TOKENS)
-                cleaned = clean_text(raw)
-                out_text = cleaned
-
-            fixed = quick_validate_and_fix(out_text, mem.get("claims"), angle=mem.get("angle"))
-            write_subsection(doc, fixed)
-
-            mem = update_memory_from_text(fixed, mem)
-            save_doc(doc, doc_path)
-
-    save_doc(doc, doc_path)
-    print(f"\\nDone. File generated:\\n{doc_path.resolve()}\\n")
+    doc_path = asyncio.run(_generate(config, title, persona, chapters, (checkpoint, book_key, done)))
+    print(f"\nDone. File generated:\n{doc_path.resolve()}\n")
 
 if __name__ == "__main__":
     if not os.getenv("OPENAI_API_KEY"):
         print("Missing OPENAI_API_KEY")
         sys.exit(1)
-    main()
+    main({"batch": True} if "--batch" in sys.argv[1:] else None)
@@ -0,0 +1,185 @@
+# bookgen_ui_helpers.py
+"""Helpers for app_streamlit.py: TOC parsing, book.yaml IO, output lookup."""
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import importlib
+import functools
+import pathlib
+from pathlib import Path
+import streamlit as st
+
+ROOT = pathlib.Path(__file__).parent
+CACHE_DIR = Path("output") / ".cache"
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+_TOC_STRIP_CHARS = " \t-•"  # bullets/dashes; .rstrip() then drops any trailing whitespace
+_CHAPTER_WORDS = frozenset(("chapter", "day"))
+_CHAPTER_RE  = re.compile(r"^(chapter|day)\s+\d+[:\- ]", re.I)
+# same table as bookgen/main.py so the output filename matches
+_BAD_CHARS = dict.fromkeys(map(ord, '\\/:*?"<>|'), ord("-"))
+
+def safe_title_for_filename(s: str) -> str:
+    return s.translate(_BAD_CHARS).strip()
+
+def _is_chapter(ln: str) -> bool:
+    # cheap tests first; the regex only runs when the first word is chapter/day
+    head = ln[:8].lower()
+    if head.startswith("part "):
+        return True
+    if head.startswith(("chapter", "day")) and ln.split(None, 1)[0].lower() in _CHAPTER_WORDS:
+        return _CHAPTER_RE.match(ln) is not None or _is_caps_line(ln)
+    return _is_caps_line(ln)
+
+def _is_caps_line(ln: str) -> bool:
+    # isupper(): no uppercased copy, stops at the first lowercase char,
+    # and is False when there are no cased letters at all
+    return len(ln) >= 4 and ln.isupper()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def parse_toc_lines(toc_text: str):
+    """
+    Convert simple pasted TOC to a chapters list usable by book.yaml.
+    - ALL CAPS or 'Chapter/Day N' -> new chapter
+    - following lines -> subsections
+    Returns (title, subs_tuple) pairs.
+    Cached on toc_text: reruns with the same paste skip the parse.
+    """
+    chapters = []
+    cur_title, subs = None, []
+
+    for raw in toc_text.splitlines():
+        ln = raw.strip(_TOC_STRIP_CHARS).rstrip()
+        if not ln:
+            continue
+        if len(ln) < 64:
+            ln = sys.intern(ln)  # repeated short headings share one object
+        if _is_chapter(ln):
+            if cur_title is not None:
+                chapters.append((cur_title, tuple(subs)))
+            cur_title, subs = ln, []
+        else:
+            if cur_title is None:
+                cur_title = "Introduction"
+            subs.append(ln)
+
+    if cur_title is not None:
+        chapters.append((cur_title, tuple(subs)))
+    return chapters
+
+def write_book_yaml_locally(title: str, persona: str, chapters_list: list, p: Path = Path("book.yaml")) -> Path:
+    """
+    Write a minimal book.yaml expected by bookgen/main.py.
+    (JSON syntax that yaml.safe_load can read.)
+    """
+    data = {
+        "title": title,
+        "persona": persona,
+        "toc": [{t: list(subs)} if subs else t for t, subs in chapters_list],
+    }
+    payload = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    try:
+        if p.stat().st_size == len(payload) and p.read_bytes() == payload:
+            return p  # unchanged inputs: keep the existing file untouched
+    except FileNotFoundError:
+        pass
+    # unique tmp (mkstemp fd) written with raw os.write, then fsync'd
+    fd, tmp = tempfile.mkstemp(dir=p.parent, prefix=p.name + ".", suffix=".tmp")
+    try:
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, p)  # atomic: bookgen never reads a half-written file
+    return p
+
+def find_output_doc(title: str, run_id: str) -> Path | None:
+    """
+    One scandir pass over output/: the exact run_id file if present,
+    otherwise the newest 'BOOK - <title> - *.docx'. Empty files (a save
+    that never completed) are skipped; one stat per candidate.
+    """
+    prefix = f"BOOK - {safe_title_for_filename(title)} - "
+    exact = f"{prefix}{run_id}.docx"
+    best, best_mt = None, -1.0
+    try:
+        with os.scandir("output") as it:
+            for e in it:
+                if not (e.name.startswith(prefix) and e.name.endswith(".docx")):
+                    continue
+                if e.name.endswith(".partial.docx"):  # in-progress checkpoint
+                    continue
+                stt = e.stat()
+                if stt.st_size == 0:
+                    continue
+                if e.name == exact:
+                    return Path(e.path)
+                if stt.st_mtime > best_mt:
+                    best, best_mt = e.path, stt.st_mtime
+    except FileNotFoundError:
+        return None
+    return Path(best) if best else None
+
+def generation_key(*parts: str) -> str:
+    """Content hash of everything that shapes the generated book."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def cached_output(key: str) -> Path | None:
+    """The .docx stored for this key by a previous run (any session)."""
+    d = CACHE_DIR / key
+    if not d.is_dir():
+        return None
+    return next((Path(e.path) for e in os.scandir(d) if e.name.endswith(".docx")), None)
+
+def store_cached_output(key: str, path: Path) -> Path:
+    """Mirror a generated .docx under output/.cache/<key>/, keeping its name."""
+    d = CACHE_DIR / key
+    d.mkdir(parents=True, exist_ok=True)
+    return Path(shutil.copy2(path, d / path.name))
+
+@functools.lru_cache(maxsize=1)
+def _has_secrets_file() -> bool:
+    return (Path(".streamlit/secrets.toml").exists()
+            or (Path.home() / ".streamlit" / "secrets.toml").exists())
+
+_SETTINGS: dict[str, str] = {}
+
+def get_setting(name: str, default: str = "") -> str:
+    """
+    Env var first; st.secrets only when a secrets.toml exists (else it raises).
+    Non-empty values are resolved once per process; misses are retried.
+    """
+    val = _SETTINGS.get(name)
+    if val:
+        return val
+    val = os.environ.get(name) or (st.secrets.get(name, "") if _has_secrets_file() else "")
+    if not val:
+        return default
+    _SETTINGS[name] = val
+    return val
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _read_docx(path: str, mtime: float, size: int) -> bytes:
+    """Read the generated .docx once; (path, mtime, size) invalidates on rewrite."""
+    with open(path, "rb", buffering=1 << 20) as fh:
+        return fh.read()
+
+def docx_payload(path: Path) -> bytes:
+    stt = path.stat()
+    return _read_docx(str(path), stt.st_mtime, stt.st_size)
+
+@st.cache_resource(show_spinner=False)
+def import_bookgen_main():
+    """Import bookgen.main once per process (the OpenAI client is created lazily)."""
+    return importlib.import_module("bookgen.main")